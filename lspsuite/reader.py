@@ -7,12 +7,31 @@ Includes high level, mid-level, and low-level functions relating to parsing outp
 Written by Gregory Ngirmang circa 2015 as part of his "lspreader" repository
 Updated by Scott Feister 2016 - 2019.
 '''
-import xdrlib as xdr
 import numpy as np
 import gzip # For reading .p4.gz files
+import io # For buffering the (g)zipped file handles
 import os # For path splitting
+import pathlib # For passing paths to liburing
 import re # For regular expression searches of the history.p4 text file
+import struct # For unpacking runs of scalars in the headers
+import zlib # For streaming decompression of whole .p4.gz files
+import mmap # For zero-copy reads of plain .p4 files
+import functools # For caching the record dtypes and structs used in parsing
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor # For reading many headers concurrently in times()
+
+try:
+    import liburing # Optional (Linux only). Batches the system calls of times() through io_uring.
+except ImportError:
+    liburing = None
+
+READ_BUFFER_SIZE = 128*1024 # Bytes. Read-ahead buffer for binary .p4(.gz) file handles, so the many tiny header reads are cheap.
+URING_HEAD_SIZE = 4096 # Bytes. How much of each uncompressed .p4 file times() reads via io_uring; covers any realistic header.
+URING_BATCH = 64 # Number of files per io_uring submission in times()
+
+# Regular expressions for the header of the history.p4 text file
+_RE_NITEMS = re.compile(rb"^#Number of data items: ([0-9]+)$", re.MULTILINE)
+_RE_LABEL = re.compile(rb"^#[0-9]+?: (.*?): (.*?)$", re.MULTILINE)
 
 ######## HIGH LEVEL: Reading various LSP output files ##########
 def read_flds(fname, flds=None):
@@ -32,14 +51,7 @@ def read_flds(fname, flds=None):
     #   2016-01-15  Added scalar read functionality back in.
     # Issues:
     #   * Unknown if this function will work for 3D field dumps. Specifically, the order of the reshaping of fields may be wrong.
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-	
-    with myopen(fname, 'rb') as file:
+    with _open_binary(fname) as file:
         # Read in the header, and check that this dump is a vector fields file or scalars file
         header = get_header(file) # Gets the header, and advances the file cursor to after the header
         if header['dump_type'] == 2:
@@ -75,30 +87,36 @@ def read_flds(fname, flds=None):
             Jp = get_float(file,N=nJ,forcearray=True)
             nK = get_int(file)
             Kp = get_float(file,N=nK,forcearray=True)
-            nAll = nI*nJ*nK
+            nAll = int(nI)*int(nJ)*int(nK) # Python ints: byte counts of big domains overflow 32-bit integers
+            qbytes = nAll*size*4 # Bytes per quantity in this domain
             #self.logprint('Dimensions are {}x{}x{}={}.'.format(nI,nJ,nK,nAll));
             d = {} # The domain data storage unit
             #print('Making points.')
             #the way meshgrid works, it has to be in this order.
-            d['xgv'] = Ip
-            d['ygv'] = Jp
-            d['zgv'] = Kp
+            d['xgv'] = Ip.astype(np.float32) # Native byte order, like the fields
+            d['ygv'] = Jp.astype(np.float32)
+            d['zgv'] = Kp.astype(np.float32)
 
             for quantity in qs:
                 if quantity not in flds_set: # Skip file cursor past unwanted fields/quantities
-                    file.seek(nAll*4*size,1)
-                else: # Read in the desired fields
+                    file.seek(qbytes,1)
+                else: # Read in the desired fields, each with a single read and a single frombuffer
                     #self.logprint('Reading in {}'.format(quantity));
-                    # COULD PROBABLY DO THIS IN ONE STEP, BUT WHAT'S THE POINT?
-                    fld_raw = get_float(file,N=nAll*size)
-                    data=fld_raw.reshape(nAll,size).T
-                    if size == 1:
-                        d[quantity] = data.reshape(nK,nJ,nI)
+                    if isinstance(file, _BufferReader): # Memory-mapped .p4: view the quantity in place, rather than copying it out with file.read()
+                        fld_raw = np.frombuffer(file.buf, dtype='>f4', count=nAll*size, offset=file.pos)
+                        file.pos += qbytes
                     else:
-                        fld_x,fld_y,fld_z= data
-                        d[quantity+'x'] = fld_x.reshape(nK,nJ,nI) # CHECK THE ORDER FOR 3D!!!
-                        d[quantity+'y'] = fld_y.reshape(nK,nJ,nI)
-                        d[quantity+'z'] = fld_z.reshape(nK,nJ,nI)
+                        fld_raw = np.frombuffer(file.read(qbytes), dtype='>f4', count=nAll*size)
+                    # Each quantity is stored interleaved by component, i.e. [x0,y0,z0,x1,y1,z1,...]
+                    data = fld_raw.reshape(nAll,size)
+                    # astype() fuses the one copy out of the buffer with the swap from big-endian to native byte order,
+                    # so that all later arithmetic on the fields runs on the fast (vectorized) native-endian paths
+                    if size == 1:
+                        d[quantity] = data.reshape(nK,nJ,nI).astype(np.float32)
+                    else: # Gather each component column straight into its own contiguous array (one copy each, no intermediate transpose)
+                        d[quantity+'x'] = data[:,0].astype(np.float32).reshape(nK,nJ,nI) # CHECK THE ORDER FOR 3D!!!
+                        d[quantity+'y'] = data[:,1].astype(np.float32).reshape(nK,nJ,nI)
+                        d[quantity+'z'] = data[:,2].astype(np.float32).reshape(nK,nJ,nI)
                     del data, fld_raw
 
             doms.append(d)
@@ -120,37 +138,30 @@ def read_pmovie(fname):
         frames: The output from read_movie. A NumPy array with multiple records.
     """
     
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-    
-    with myopen(fname, 'rb') as file:
+    with _open_binary(fname) as file:
         header = get_header(file)
         frames = read_pmovie_ll(file, header)
     return frames
 
 def read_pmovie_ll(file, header):
     params,_  = zip(*header['params']);
-    nparams = len(params);
-    pbytes = (nparams+1)*4;
+    dt = _pmovie_dtype(params);
+    dt_native = dt.newbyteorder('=');
     frames=[];
-    pos0 = file.tell(); 
-    while not iseof(file):
-        d=get_dict(file, 'fii',['t','step','pnum']);
-        d['pos']=file.tell();
-        file.seek(d['pnum']*pbytes,1);
+    # Slurp the (decompressed) rest of the file, and locate every frame by its offset within it (no EOF tests, no seeking)
+    if isinstance(file, _BufferReader): # e.g. a memory-mapped .p4: no need to copy it
+        buf = memoryview(file.buf)[file.pos:];
+        file.pos = len(file.buf);
+    else:
+        buf = file.read();
+    st = _fmt_struct('fii');
+    off = 0;
+    while off < len(buf):
+        t, step, pnum = st.unpack_from(buf, off);
+        d = {'t':np.float32(t), 'step':np.int32(step), 'pnum':np.int32(pnum)};
+        d['data']=np.frombuffer(buf,dtype=dt,count=pnum,offset=off+st.size).astype(dt_native); # copy (writeable, detached from buf) and swap to native byte order
         frames.append(d);
-    for i,d in enumerate(frames):
-        N = d['pnum'];
-        lt = [('ip','>i4')] + list(zip(params,['>f4']*nparams));
-        file.seek(d['pos']);
-        arr=np.frombuffer(file.read(N*4*len(lt)),dtype=np.dtype(lt),count=N);
-        arr.flags.writeable = True;
-        frames[i].update({'data':arr});
-        del frames[i]['pos'];
+        off += st.size + pnum*dt.itemsize;
     return frames;
     
 def read_pext(fname):
@@ -161,16 +172,10 @@ def read_pext(fname):
         out: The output from read_pext. A NumPy array with multiple records.
     """
     
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-    
-    with myopen(fname, 'rb') as file:
-        header = get_header(file)
-        out = read_pext_ll(file, header)
+    # Decompress the whole file straight into one bytearray, so the records can be viewed in place (no second copy of the data)
+    file = _BufferReader(_read_whole(fname))
+    header = get_header(file)
+    out = read_pext_ll(file, header)
     return out
 
 def read_pext_ll(file, header, lowlev=False):
@@ -184,13 +189,22 @@ def read_pext_ll(file, header, lowlev=False):
     elif nparams == 12:
         params+=['E','xi','yi','zi']
     #it's just floats here on out
-    dt = list(zip(params, ['>f4']*len(params)))
-    if lowlev: # more efficient, but does not work with .p4.gz file handles
+    dt = _pext_dtype(tuple(params))
+    if isinstance(file, _BufferReader): # in-memory buffer or memory-mapped .p4 (also when lowlev): view the records in place
+        out = np.frombuffer(file.buf, dtype=dt, offset=file.pos)
+        file.pos = len(file.buf)
+    elif lowlev: # more efficient, but needs a real OS file object (not .p4.gz file handles)
         out = np.fromfile(file,dtype=dt,count=-1)
     else: # works with all file handles
         s = file.read()
-        out=np.fromstring(s, dtype=dt,count=-1)
-    return out
+        out=np.frombuffer(s, dtype=dt).copy() # copy, so the output is writeable (frombuffer of bytes is read-only)
+    # Swap the records to native byte order (in place, if writeable), so later arithmetic on them is not slowed by big-endian data
+    if not out.flags.writeable: # e.g. viewed from a memory-mapped .p4
+        return out.astype(dt.newbyteorder('='))
+    if dt.isnative: # Big-endian host: nothing to swap
+        return out
+    out.byteswap(inplace=True)
+    return out.view(dt.newbyteorder()) # The swapped bytes are in the opposite (i.e. native, little-endian) order
 
 def read_history(fname):
     """ Read probes in the 'history.p4' or 'history.p4.gz' file 
@@ -200,33 +214,35 @@ def read_history(fname):
         values: 2D NumPy array: (N x tsteps) If there are N probes, and tsteps time steps in the simulation.
         labels: list, length N, of two-element tuples with each tuple containing ('probe name', 'units')
     
-    Note: Reads the entire file twice into memory. Not efficient if for some reason history.p4 is a huge file.
+    Note: Reads (and decompresses) the file only once, but holds its full text in memory while parsing.
     Note: Not thoroughly tested. Not a super-duper rigorous function (assumes a certain format, doesn't do as many checks as it should), so don't be surprised if it breaks.
     """
 
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-        
-    ## Read in the entire file as a string to look at the header (inefficient)
-    with myopen(fname, 'r') as f:
+    ## Read in the entire file as bytes, once. Both the header and the probe data are parsed from these bytes (no decoding of the whole file).
+    with _open_binary(fname) as f:
         s = f.read()
     
     ## Look at the header and extract the number of probes and their labels (including their units)
-    m1 = re.search(r"^#Number of data items: ([0-9]{1,})$", s, re.MULTILINE) # e.g. reading "Number of data items: 9" and extracting 9
+    m1 = _RE_NITEMS.search(s) # e.g. reading "Number of data items: 9" and extracting 9
     if not m1:
         raise Exception("Something's wrong with the .p4 file or reader. Couldn't find a 'Number of data items' entry.")
     else:
         nitems = int(m1.group(1)) # This is the number of probes. Assume there are this many header lines, plus four more.
     
-    labels = re.findall(r"^#[0-9]{1,}?: (.*?): (.*?)$", s, re.MULTILINE) # e.g. reading "#0: time: ns", extracting the tuple ('time', 'ns')
-    del s
+    labels = [(name.decode(), unit.decode()) for (name, unit) in _RE_LABEL.findall(s)] # e.g. reading "#0: time: ns", extracting the tuple ('time', 'ns')
 
-    ## Read in the array of probe data
-    values = np.genfromtxt(fname, skip_header = nitems + 4).swapaxes(0,1)[1:] # Fortunately, genfromtext works natively on .gz files as well
+    ## Read in the array of probe data, from the text following the header lines
+    body = s.split(b'\n', nitems + 4)[-1]
+    del s
+    try:
+        import pandas as pd # Optional, and imported only here as it is slow to import. Its C parser is considerably faster than numpy's text readers.
+    except ImportError:
+        pd = None
+    if pd is not None:
+        values = pd.read_csv(io.BytesIO(body), sep=r'\s+', header=None, comment='#', dtype=np.float64).to_numpy().swapaxes(0,1)[1:]
+    else:
+        values = np.loadtxt(io.BytesIO(body), ndmin=2).swapaxes(0,1)[1:]
+    del body
     
     ## Make sure we didn't screw something up royally, that we have the same number of probe labels as probe dimensions
     if np.abs(len(labels) - values.shape[0]) > 0.5:
@@ -240,15 +256,8 @@ def read_grid(fname):
     fname: filename (e.g. fname = "/home/joeblow/myrun/grid.p4")
     
     """
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-
     d = OrderedDict()
-    with myopen(fname, 'r') as f:
+    with _open_text(fname) as f:
         d['title'] = f.readline().strip()
         d['GEOMETRY'] = int(f.readline().strip())
         d['DIMENSION'] = int(f.readline().strip())
@@ -257,112 +266,172 @@ def read_grid(fname):
         d['z_units'] = f.readline().strip()
         d['ngrids'] = int(f.readline().strip()) # Number of grids
         
-        grids = [OrderedDict()]*d['ngrids'] # Make a list of grids
+        grids = [OrderedDict() for _ in range(d['ngrids'])] # Make a list of grids (distinct dicts, not N references to one dict)
         d['grids'] = grids
         for i in range(d['ngrids']): # For each grid
             grids[i]['index'] = int(f.readline().strip())
             
+            # Each grid vector is one value per line; np.loadtxt parses exactly that many lines in one call
             nI = int(f.readline().strip())
             grids[i]['nI'] = nI
-            grids[i]['xgv'] = np.zeros(nI)
-            for j in range(nI):
-                grids[i]['xgv'][j] = float(f.readline().strip())
+            grids[i]['xgv'] = np.loadtxt(f, max_rows=nI, dtype=np.float64, ndmin=1)
                 
             nJ= int(f.readline().strip())
             grids[i]['nJ'] = nJ
-            grids[i]['ygv'] = np.zeros(nJ)
-            for j in range(nJ):
-                grids[i]['ygv'][j] = float(f.readline().strip())
+            grids[i]['ygv'] = np.loadtxt(f, max_rows=nJ, dtype=np.float64, ndmin=1)
                 
             nK= int(f.readline().strip())
             grids[i]['nK'] = nK
-            grids[i]['zgv'] = np.zeros(nK)
-            for j in range(nK):
-                grids[i]['zgv'][j] = float(f.readline().strip())
+            grids[i]['zgv'] = np.loadtxt(f, max_rows=nK, dtype=np.float64, ndmin=1)
     return d
 
 # TODO: Test on a more-than-one region
 def read_regions(fname):
     """ Read an (always-ASCII) 'regions.p4' or 'regions.p4.gz' LSP output file into a python dictionary """
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-
     d = OrderedDict()
-    with myopen(fname, 'r') as f:
+    with _open_text(fname) as f:
         d['title'] = f.readline().strip()
         d['GEOMETRY'] = int(f.readline().strip())
         d['DIMENSION'] = int(f.readline().strip())
         d['nregions'] = int(f.readline().strip()) # Number of regions
-        regs = [OrderedDict()]*d['nregions'] # Make a list of regions
+        regs = [OrderedDict() for _ in range(d['nregions'])] # Make a list of regions (distinct dicts, not N references to one dict)
         d['regions'] = regs
+        lines = f.read().splitlines() # The rest of the file: two lines per region
         for i in range(d['nregions']): # For each region
-            line = f.readline().strip()
-            myarr = np.fromstring(line, dtype='int', sep=" ", count=3)
+            myarr = np.array(lines[2*i].split()[:3], dtype=np.int64)
             (regs[i]['nI'], regs[i]['nJ'], regs[i]['nK']) = myarr
     
-            line = f.readline().strip()
-            myarr = np.fromstring(line, dtype='float', sep=" ", count=6)
+            myarr = np.array(lines[2*i+1].split()[:6], dtype=np.float64)
             (regs[i]['xmin'], regs[i]['xmax'], regs[i]['ymin'], regs[i]['ymax'], regs[i]['zmin'], regs[i]['zmax']) = myarr
     return d
 
 # TODO: Test on a non-zero volume
 def read_volumes(fname):
     """ Read an (always-ASCII) 'volumes.p4' or 'volumes.p4.gz' LSP output file into a python dictionary """
-    _, ext = os.path.splitext(fname)
-    
-    if ext == '.gz':
-        myopen = gzip.open # If the file is .p4.gz, open using gunzip
-    else:
-        myopen = open
-
     d = OrderedDict()
-    with myopen(fname, 'r') as f:
+    with _open_text(fname) as f:
         d['title'] = f.readline().strip()
         d['nvolumes'] = int(f.readline().strip()) # Number of regions
-        vols = [OrderedDict()]*d['nvolumes'] # Note: If no volumes, this returns an empty list, which is fine -- just FYI.
+        vols = [OrderedDict() for _ in range(d['nvolumes'])] # Note: If no volumes, this returns an empty list, which is fine -- just FYI.
         d['volumes'] = vols
+        lines = f.read().splitlines() # The rest of the file: one line per volume
         for i in range(d['nvolumes']):
-            line = f.readline().strip()
-            myarr = np.fromstring(line, dtype='float', sep=" ", count=7)
-            (_, vols[i]['x0'], vols[i]['x1'], vols[i]['y0'], vols[i]['y1'], vols[i]['z0'], vols[i]['z1']) = myarr
-            myarr = np.fromstring(line, dtype='int', sep=" ", count=1)
+            words = lines[i].split()
+            myarr = np.array(words[1:7], dtype=np.float64)
+            (vols[i]['x0'], vols[i]['x1'], vols[i]['y0'], vols[i]['y1'], vols[i]['z0'], vols[i]['z1']) = myarr
+            myarr = np.array(words[:1], dtype=np.int64)
             (vols[i]['type'],) = myarr
     return d
     
 ################ HIGH LEVEL: Extracting simulation times from headers ################
-def times(fns):
+def times(fns, use_uring=True):
     """ Get a list of times (in ns), from a list of flds or sclr .p4(.gz) filenames.
     
+    If use_uring is True (default) and the optional "liburing" package is available (Linux), the headers of
+    uncompressed .p4 files are read with batched io_uring system calls. Everything else is read on a thread pool.
+    
     Example usage:
     import lspsuite as ls
     mytimes = ls.times(ls.listp4(".", "flds"))
     """
     
     nfiles = len(fns)
-    times = np.zeros(nfiles)    
-    for i in range(nfiles):
-        fn = fns[i]
-        _, ext = os.path.splitext(fn)
-        
-        if ext == '.gz':
-            with gzip.open(fn, 'rb') as f:
-                header = get_header(f)
-        else:
-            with open(fn, 'rb') as f:
-                header = get_header(f)
+    times = np.zeros(nfiles, dtype=np.float64)
+    todo = list(range(nfiles)) # Indices of the files whose times are still to be read
+    if use_uring and liburing is not None:
+        plain = [i for i in todo if os.path.splitext(fns[i])[1] != '.gz'] # Gunzipping is CPU-bound, so .p4.gz files stay on the thread pool
+        try:
+            heads = _read_heads_uring([fns[i] for i in plain])
+        except OSError: # e.g. io_uring is disabled by the kernel or a container's seccomp profile. Fall back to the thread pool.
+            heads = None
+        if heads is not None:
+            for i, head in zip(plain, heads):
+                times[i] = _head_timestamp(fns[i], head)
+            todo = sorted(set(todo) - set(plain))
+    if len(todo) < 1:
+        return times
+    # Each file is independent and the work is open + gunzip of a tiny header, so read them concurrently (map preserves order)
+    with ThreadPoolExecutor(max_workers=min(32, len(todo))) as executor:
+        for i, t in zip(todo, executor.map(_read_timestamp, [fns[i] for i in todo])):
+            times[i] = t
 
-        if not (header['dump_type'] == 2 or header['dump_type'] == 3):
-            # this is a fields file or a scalars file.
-            times[i] = header['timestamp']
-        else:
-            raise NotImplementedError('Not implemented for .p4 files other than flds or sclr.');
+    return times
 
+def _read_timestamp(fn):
+    """ Worker for times(): read the simulation time (in ns) out of the header of a single flds or sclr .p4(.gz) file """
+    with _open_binary(fn) as f:
+        header = get_header(f, stop_after='timestamp')
+    return _header_timestamp(header)
 
-    return times
+def _head_timestamp(fn, head):
+    """ Simulation time (in ns) from the first bytes "head" of the flds or sclr .p4 file fn, as read by _read_heads_uring() """
+    try:
+        header = get_header(io.BytesIO(head), stop_after='timestamp')
+    except (ValueError, struct.error): # The header didn't fit within URING_HEAD_SIZE bytes; read this one the usual way
+        return _read_timestamp(fn)
+    return _header_timestamp(header)
+
+def _header_timestamp(header):
+    """ Simulation time (in ns) from a header dict, as generated by "get_header()" """
+    if header['dump_type'] == 2 or header['dump_type'] == 3:
+        # this is a fields file or a scalars file.
+        return header['timestamp']
+    else:
+        raise NotImplementedError('Not implemented for .p4 files other than flds or sclr.');
+
+def _read_heads_uring(fns):
+    """ Read the first URING_HEAD_SIZE bytes of each of a list of (uncompressed) files, batching the open, read and close system calls through io_uring
+    Inputs:
+        fns: list of filename strings
+    Outputs:
+        heads: list of bytes objects, one per file
+    """
+    heads = []
+    if len(fns) < 1:
+        return heads
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(URING_BATCH, ring)
+    try:
+        for start in range(0, len(fns), URING_BATCH):
+            paths = [pathlib.Path(fn) for fn in fns[start:start+URING_BATCH]] # Keep these referenced until submitted
+            fds = _uring_run(ring, cqe, [(liburing.io_uring_prep_open, (path, liburing.O_RDONLY)) for path in paths])
+            opened = [fd for fd in fds if not isinstance(fd, OSError)]
+            bufs = [bytearray(URING_HEAD_SIZE) for fd in opened]
+            nreads = _uring_run(ring, cqe, [(liburing.io_uring_prep_read, (fd, buf, 0)) for fd, buf in zip(opened, bufs)])
+            _uring_run(ring, cqe, [(liburing.io_uring_prep_close, (fd,)) for fd in opened])
+            for res in fds + nreads:
+                if isinstance(res, OSError):
+                    raise res
+            heads += [bytes(buf[:n]) for buf, n in zip(bufs, nreads)]
+    finally:
+        liburing.io_uring_queue_exit(ring)
+    return heads
+
+def _uring_run(ring, cqe, preps):
+    """ Submit one io_uring operation per (prep_function, args) pair in preps, with a single system call, and wait for them all to complete.
+    Returns the result of each operation (in the order of preps), or the OSError it failed with.
+    """
+    for k, (prep, args) in enumerate(preps):
+        sqe = liburing.io_uring_get_sqe(ring)
+        prep(sqe, *args)
+        sqe.user_data = k
+    out = [None]*len(preps)
+    liburing.io_uring_submit_and_wait(ring, len(preps))
+    ndone = 0
+    while ndone < len(preps):
+        liburing.io_uring_wait_cqe(ring, cqe)
+        ready = liburing.io_uring_cq_ready(ring)
+        for i in range(ready):
+            entry = cqe[i]
+            k = entry.user_data
+            try:
+                out[k] = entry.res
+            except OSError as err: # The wrapper raises on a negative result (-errno)
+                out[k] = err
+        liburing.io_uring_cq_advance(ring, ready)
+        ndone += ready
+    return out
 
 ######## MID LEVEL: Reading the header section of a p4 file ##########
 def get_header(file,**kw):
@@ -370,10 +439,13 @@ def get_header(file,**kw):
        Advanced the file position to the end of the header.
        
        Returns the size of the header, and the size of the header, if the header keyword is true.
+       
+       For flds and sclr files, stop_after='timestamp' returns as soon as the timestamp, geometry and number of domains
+       are read, without the quantities (and leaves the file position there, not at the end of the header).
     '''
     if type(file) == str:
         #if called with a filename, recall with opened file.
-        with open(file,'r') as f:
+        with _open_binary(file) as f:
             return get_header(f,**kw);
     if test(kw, "size"):
         size = file.tell();
@@ -384,12 +456,17 @@ def get_header(file,**kw):
         #this is a fields file or a scalars file.
         d = get_dict(file,'fii',['timestamp','geometry','domains']);
         header.update(d);
+        if kw.get('stop_after') == 'timestamp':
+            #skip the (many small) reads of the quantity names and units.
+            if test(kw,'size'):
+                return header, file.tell()-size;
+            return header;
         #reading quantities
         n = get_int(file);
         names=[get_str(file) for i in range(n)];
         units=[get_str(file) for i in range(n)];
         #print "Now I'm done reading units!"
-        header['quantities'] = zip(names,units);
+        header['quantities'] = list(zip(names,units)); # A list, not a one-shot zip iterator, so the header can be reused
     elif header['dump_type'] == 6:
         #this is a particle movie file
         d = get_dict(file,
@@ -429,27 +506,31 @@ def get_int(file,N=1,forcearray=False,lowlev=False):
     # If forcearray is True, the output will always be a numpy array.
     
     dtype = np.dtype('>i4')
-    if lowlev:
+    if lowlev and not isinstance(file, _BufferReader): # np.fromfile needs a real OS file object
         ret=np.fromfile(file,dtype=dtype,count=N)    
     else:
         s = file.read(dtype.itemsize * N)  
-        ret=np.fromstring(s, dtype=dtype,count=N)
+        ret=np.frombuffer(s, dtype=dtype,count=N)
         
     if N==1 and not forcearray:
         return ret[0];
+    if not ret.flags.writeable:
+        ret = ret.copy() # frombuffer gives a read-only view of the bytes; hand back a writeable array as before
     return ret;
     
 def get_float(file,N=1,forcearray=False,lowlev=False):
     # If forcearray is True, the output will always be a numpy array.
     dtype = np.dtype('>f4')
-    if lowlev:
+    if lowlev and not isinstance(file, _BufferReader): # np.fromfile needs a real OS file object
         ret=np.fromfile(file,dtype=dtype,count=N)    
     else:
         s = file.read(dtype.itemsize * N)  
-        ret=np.fromstring(s, dtype=dtype,count=N)
+        ret=np.frombuffer(s, dtype=dtype,count=N)
 
     if N==1 and not forcearray:
         return ret[0];
+    if not ret.flags.writeable:
+        ret = ret.copy() # frombuffer gives a read-only view of the bytes; hand back a writeable array as before
     return ret;
 
 def get_str(file):
@@ -458,10 +539,8 @@ def get_str(file):
     if l1 != l2:
         print("warning, string prefixes are not equal...");
         print("{}!={}".format(l1,l2));
-    size=l1;
-    if l1%4:
-        size+=4-l1%4;
-    return xdr.Unpacker(file.read(size)).unpack_fstring(l1).decode('utf-8');
+    size = l1 + (-l1 % 4); # XDR strings are padded to a multiple of 4 bytes
+    return file.read(size)[:l1].decode('utf-8', errors='replace');
 
 def get_list(file,fmt):
     '''makes a list out of the fmt from the LspOutput f using the format
@@ -469,8 +548,14 @@ def get_list(file,fmt):
        f for float
        d for double
        s for string'''
-    out=[]
-    for i in fmt:
+    # The leading run of numbers (e.g. the 'ii' of 'iiss', or all of 'fii') is read and unpacked in one go
+    prefix = fmt[:len(fmt) - len(fmt.lstrip('ifd'))]
+    if prefix:
+        st = _fmt_struct(prefix)
+        out = [_SCALAR_TYPES[c](v) for c,v in zip(prefix, st.unpack(file.read(st.size)))]
+    else:
+        out=[]
+    for i in fmt[len(prefix):]:
         if i == 'i':
             out.append(get_int(file));
         elif i == 'f' or i == 'd':
@@ -481,12 +566,114 @@ def get_list(file,fmt):
             raise ValueError("Unexpected flag '{}'".format(i));
     return out;
     
+_SCALAR_TYPES = {'i': np.int32, 'f': np.float32, 'd': np.float32} # Same scalar types as get_int() and get_float() return
+
+@functools.lru_cache(maxsize=None)
+def _fmt_struct(fmt):
+    ''' Precompiled big-endian struct for a run of get_list() numeric flags. Note 'd' is read as a 4-byte float, like get_float(). '''
+    return struct.Struct('>' + fmt.replace('d','f'))
+
 def get_dict(file,fmt,keys):
     return dict(
         zip(keys, get_list(file,fmt))
     );
     
 ######## Miscellaneous: Helper functions for the above ##########
+def _open_binary(fname):
+    """ Open a .p4 or .p4.gz file for binary reading.
+    A .p4.gz file is read behind a READ_BUFFER_SIZE read-ahead buffer. A plain .p4 file is memory-mapped, and returned as
+    a _BufferReader over the map, so that bulk data can be viewed straight from the page cache (see read_flds).
+    """
+    _, ext = os.path.splitext(fname)
+    if ext == '.gz':
+        return io.BufferedReader(gzip.open(fname, 'rb'), buffer_size=READ_BUFFER_SIZE) # If the file is .p4.gz, open using gunzip
+    with open(fname, 'rb') as f:
+        try:
+            return _BufferReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) # The map stays valid after f is closed
+        except (ValueError, OSError): # e.g. an empty file, or one that can't be mapped
+            pass
+    return open(fname, 'rb', buffering=READ_BUFFER_SIZE)
+
+def _read_whole(fname):
+    """ Read the entire contents of a .p4 file, or the decompressed contents of a .p4.gz file, into a single bytearray.
+    Compressed data are fed to zlib in READ_BUFFER_SIZE chunks, and the output appended in place, so the peak memory is about one copy of the data.
+    """
+    _, ext = os.path.splitext(fname)
+    if ext != '.gz':
+        buf = bytearray(os.path.getsize(fname))
+        view = memoryview(buf)
+        n = 0
+        with open(fname, 'rb', buffering=0) as f:
+            while n < len(buf):
+                nread = f.readinto(view[n:])
+                if not nread:
+                    break
+                n += nread
+        del view
+        del buf[n:]
+        return buf
+    buf = bytearray()
+    dctx = zlib.decompressobj(32 + zlib.MAX_WBITS) # 32+: expect a gzip header
+    with open(fname, 'rb') as f:
+        chunk = f.read(READ_BUFFER_SIZE)
+        while chunk:
+            buf += dctx.decompress(chunk)
+            if dctx.eof and dctx.unused_data: # Another gzip member follows (concatenated .gz)
+                chunk = dctx.unused_data
+                dctx = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            else:
+                chunk = f.read(READ_BUFFER_SIZE)
+    buf += dctx.flush()
+    if not dctx.eof: # Truncated .p4.gz, e.g. still being written; gzip.open() raises the same
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    return buf
+
+class _BufferReader(object):
+    """ Minimal read-only file-like cursor over an in-memory buffer (e.g. from _read_whole, or an mmap), for get_header() and friends """
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self.buf) - self.pos
+        n = int(n) # Sizes from get_int() are 32-bit NumPy integers, which would overflow once added to a position past 2 GiB
+        out = bytes(memoryview(self.buf)[self.pos:self.pos+n])
+        self.pos += len(out)
+        return out
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        offset = int(offset) # See read()
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.buf)
+        self.pos = offset
+        return self.pos
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            try:
+                self.buf.close()
+            except BufferError: # NumPy views of the map are still alive; it is unmapped once they are garbage collected
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _open_text(fname):
+    """ Open a (possibly gzipped) ASCII .p4 or .p4.gz file for text reading, behind a READ_BUFFER_SIZE read-ahead buffer """
+    _, ext = os.path.splitext(fname)
+    if ext == '.gz':
+        return io.TextIOWrapper(_open_binary(fname))
+    return open(fname, 'r', buffering=READ_BUFFER_SIZE)
+
 # Define a basic function for checking (and get rid of an old misc.py dependency)
 test = lambda d,k: k in d and d[k];
 
@@ -497,6 +684,16 @@ def iseof(file):
         return True;
     file.seek(c);
     
+@functools.lru_cache(maxsize=None)
+def _pmovie_dtype(params):
+    """ Record dtype of one particle in a pmovie frame, for a tuple of parameter names (cached, as it is the same for every file of a run) """
+    return np.dtype([('ip','>i4')] + [(p,'>f4') for p in params])
+
+@functools.lru_cache(maxsize=None)
+def _pext_dtype(params):
+    """ Record dtype of one particle in a pext file, for a tuple of parameter names (cached, as it is the same for every file of a run) """
+    return np.dtype([(p,'>f4') for p in params])
+
 def pseek(file):
     # Print out the current file seek position ("file.tell")
     print("Current file seek position: " + str(file.tell()))